@@ -1,6 +1,13 @@
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import earthaccess
+import h5netcdf
+import h5py
 import xarray as xr
 import numpy as np
 import pandas as pd
@@ -8,17 +15,28 @@ from loguru import logger
 
 from tqdm import tqdm
 
+# Reflectance spectra are strongly correlated across bands and compress well
+COMPRESSION = {'zlib': True, 'complevel': 3, 'shuffle': True}
+
+# CMR collection short names per product type
+SHORT_NAMES = {'Rrs': 'PACE_OCI_L2_AOP', 'Rrc': 'PACE_OCI_L2_RRC'}
+
+# l2_flags bits rejected by filter_rrc
+MASK_BITS = (1 << 1) | (1 << 3) | (1 << 5)
+
 class OverpassExtractor:
-    def __init__(self, output_dir="pace_data", batch_size=50):
+    def __init__(self, output_dir="pace_data", batch_size=50, max_workers=16):
         """
         Initializes the extractor with a focus on batch processing and resumption.
         
         Args:
             output_dir: Directory where checkpoints and final NetCDF files are stored.
             batch_size: Number of granules to process before saving a checkpoint.
+            max_workers: Number of worker processes used to stream and extract granules concurrently.
         """
         self.output_dir = Path(output_dir)
         self.batch_size = batch_size
+        self.max_workers = max_workers
         self.output_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"Initialized OverpassExtractor | Directory: {self.output_dir}")
     
@@ -30,8 +48,8 @@ class OverpassExtractor:
             lat, lon: Station coordinates.
             temporal_range: Tuple of (start_date, end_date) e.g., ("2024-04-11", "2025-12-31").
         """
-        short_name = "PACE_OCI_L2_AOP" if product_type == "Rrs" else "PACE_OCI_L2_RRC"
-        logger.info(f"Searching for {product_type} granules at ({lat}, {lon}) for {temporal}...")
+        short_name = SHORT_NAMES[product_type]
+        logger.info(f"Searching for {product_type} granules at ({lat}, {lon}) for {temporal_range}...")
         results = earthaccess.search_data(
             short_name=short_name,
             point=(lon, lat),
@@ -41,110 +59,266 @@ class OverpassExtractor:
         logger.info(f"Found {len(results)} granules for {product_type}.")
         return results
 
-    def _get_checkpoint_path(self, station_code:str, product_type:str, batch_index:int) -> Path:
-        """Helper to generate standardized checkpoint filenames."""
-        batch_num = batch_index // self.batch_size
-        return self.output_dir / f"checkpoint_{station_code}_{product_type}_b{batch_num:04d}.nc"
+    def _is_finalized(self, final_path: Path, station_code: str) -> bool:
+        """
+        Helper to check that a final file exists and was completely written for the station.
+        The .done marker answers without opening the file; files written before markers
+        existed are validated by their station_code attribute instead.
+        """
+        if not final_path.exists():
+            return False
+        if final_path.with_suffix('.done').exists():
+            return True
+        try:
+            with h5netcdf.File(final_path, 'r') as nc:
+                return nc.attrs.get('station_code') == station_code
+        except Exception as e:
+            logger.warning(f"[{station_code}] - Unreadable final file {final_path.name}: {e}")
+            return False
 
+    def _read_checkpoint_starts(self, checkpoints: list[Path]) -> dict[Path, str|None]:
+        """
+        Helper to read each checkpoint header once, mapping its path to its start time.
+        Unreadable checkpoints map to None; checkpoints numbered by batch end index
+        (b0001 for the first batch) predate the header and map to ''.
+        """
+        starts = {}
+        for cp in checkpoints:
+            try:
+                starts[cp] = _checkpoint_start(cp)
+            except Exception:
+                starts[cp] = None
+        return starts
 
-    def _extract_granule_pixel(self, file_obj, lat: float, lon: float, var_name: str) -> xr.Dataset:
+    def _quarantine_checkpoints(self, station_code: str, checkpoint_starts: dict[Path, str|None]) -> int:
         """
-        Auxiliary: Opens a single PACE NetCDF and extracts the closest pixel spectra.
-        Handles the OCI hierarchical group structure.
+        Helper to move unreadable checkpoints (e.g. truncated by a killed run) aside as .bad
+        and drop them from `checkpoint_starts`. Returns how many were moved.
         """
-        with xr.open_dataset(file_obj, group='navigation_data') as ds_nav, \
-             xr.open_dataset(file_obj, group='geophysical_data') as ds_geo, \
-             xr.open_dataset(file_obj, group='sensor_band_parameters') as ds_band:
+        corrupt = [cp for cp, start in checkpoint_starts.items() if start is None]
+        for cp in corrupt:
+            logger.warning(f"[{station_code}] - Corrupt checkpoint {cp.name} moved aside.")
+            cp.rename(cp.with_suffix('.bad'))
+            del checkpoint_starts[cp]
+        return len(corrupt)
+
+    def _get_checkpoint_path(self, station_code:str, product_type:str, batch_index:int) -> Path:
+        """Helper to generate standardized checkpoint filenames."""
+        batch_num = batch_index // self.batch_size
+        return self.output_dir / f"checkpoint_{station_code}_{product_type}_b{batch_num:04d}.nc"
 
-            # Find closes pixel using Euclidean distance on 2D lat/lon arrays
-            dist = np.sqrt((ds_nav.latitude - lat)**2 + (ds_nav.longitude - lon)**2)
-            idx = dist.argmin()
-            iy, ix = np.unravel_index(idx.values, dist.shape)
 
-            return xr.Dataset(
-                {
-                    var_name: (["wavelength"],ds_geo[var_name].isel(number_of_lines=iy, pixels_per_line=ix).values)},
-                    coords = {
-                        'wavelength': ds_band.wavelength.values,
-                        'time': pd.to_datetime(ds_nav.attrs['time_coverage_start']),
-                        'l2_flags': ds_geo.l2_flags.isel(number_of_lines=iy, pixels_per_line=ix).values,
-                        'lat': ds_nav.latitude.isel(number_of_lines=iy, pixels_per_line=ix).values,
-                        'lon': ds_nav.longitude.isel(number_of_lines=iy, pixels_per_line=ix).values
-                    }
-            )
-        
-    
     def extract_and_save(self, station_code:str, granules, lat: float, lon: float, product_type: str):
         """
         Orchestrates the extraction process with checkpoint resumption and batch saving.
         """
 
         final_path = self.output_dir / f"{station_code}_{product_type}_final.nc"
-        if final_path.exists():
+        if self._is_finalized(final_path, station_code):
             logger.info(f"[{station_code}] {product_type}: Final file exists. Skipping.")
             return final_path
         
-        # Determine how many granules are already processed via checkpoints
+        # Determine which granules are already processed via checkpoints
         checkpoints = sorted(list(
                 self.output_dir.glob(
                     f"checkpoint_{station_code}_{product_type}_b*.nc")
                 ))
+        # Headers are read once here and reused when finalizing
+        checkpoint_starts = self._read_checkpoint_starts(checkpoints)
+        if '' in checkpoint_starts.values():
+            logger.error(
+                f"[{station_code}] {product_type}: Checkpoints use the old end-index numbering and would be "
+                f"overwritten on resume. Finalize them with the previous version or delete them.")
+            return None
+        # Quarantined batches count as missing, so they are redone below
+        self._quarantine_checkpoints(station_code, checkpoint_starts)
         total_granules = len(granules)
-        processed_count = len(checkpoints) * self.batch_size
+        # Redo every batch without a checkpoint, including ones whose write failed or was corrupt
+        saved_batches = {_batch_number(cp) for cp in checkpoint_starts}
+        pending = [i for i in range(total_granules) if i // self.batch_size not in saved_batches]
+        processed_count = total_granules - len(pending)
 
-        if processed_count >= total_granules and total_granules > 0:
+        if not pending and total_granules > 0:
             logger.info(
                 f"[{station_code}] - All granules present in checkpoints. Finalizing...")
-            return self._finalize_station(station_code, product_type, final_path)
+            return self._finalize_station(station_code, product_type, final_path, checkpoint_starts)
         
         logger.info(
             f"[{station_code}] {product_type}: Processed {processed_count} / {total_granules}. Resuming...")
         
-        remaining_granules = granules[processed_count:]
         var_name = "Rrs" if product_type == "Rrs" else "Rrc"
-        current_batch = []
         
-        # Open S3/HTTP streams
-        files = earthaccess.open(remaining_granules)
-        for i, f in enumerate(
-            tqdm(files, initial=processed_count, total=total_granules, desc=f"OCI {station_code}")):
+        # Open S3/HTTP streams. earthaccess (>=0.15) opens them with fsspec's background
+        # block cache, sizing blocks by file size, so HDF5's small reads are prefetched.
+        files = earthaccess.open([granules[i] for i in pending])
+        # Results are slotted by position within their batch, so checkpoints keep the granule order
+        batch_results = {}
+        batch_remaining = {}
+        for i in pending:
+            b = i // self.batch_size
+            batch_results[b] = [None] * (min((b + 1) * self.batch_size, total_granules) - b * self.batch_size)
+            batch_remaining[b] = batch_remaining.get(b, 0) + 1
+        failed_batches = []
+
+        # h5py holds a global lock for the whole read, including the file object's
+        # network I/O, so granules are extracted in separate processes. Workers are
+        # spawned, not forked: by now fsspec, tqdm and dask threads run in this process,
+        # and forking a multi-threaded process can deadlock. earthaccess file objects
+        # re-authenticate when they are unpickled in a fresh worker.
+        with ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')
+        ) as ex:
+            futures = {
+                ex.submit(_extract_granule_pixel, f, lat, lon, var_name): (i, f)
+                for i, f in zip(pending, files)
+            }
+            del files
+
+            # Checkpoints are written by a background thread while extraction continues
+            write_queue = queue.Queue(maxsize=2)
+            writer = threading.Thread(
+                target=self._checkpoint_writer, args=(write_queue, checkpoint_starts, failed_batches), daemon=True)
+            writer.start()
+
             try:
-                ds_pixel = self._extract_granule_pixel(f, lat, lon, var_name)
-                current_batch.append(ds_pixel)
-
-                global_idx = processed_count + i + 1
-                # Save checkpoint if batch is full or it's the last granule
-                if (global_idx % self.batch_size == 0) or (global_idx == total_granules):
-                    batch_path = self._get_checkpoint_path(station_code, product_type, global_idx)
-                    xr.concat(current_batch, dim='time').to_netcdf(batch_path)
-                    logger.info(f"Saved Checkpoint: {batch_path.name} ({global_idx}/{total_granules})")
-                    current_batch = []
-            except Exception as e:
-                logger.error(f"Failed Granule {processed_count + i}: {e}")
-                continue
+                with tqdm(initial=processed_count, total=total_granules, desc=f"OCI {station_code}",
+                          mininterval=2.0) as pbar:
+                    for future in as_completed(futures):
+                        # Drop the parent's handle (and its block cache) once the granule is done
+                        i, f = futures.pop(future)
+                        _close(f)
+                        b = i // self.batch_size
+                        try:
+                            batch_results[b][i - b * self.batch_size] = future.result()
+                        except Exception as e:
+                            logger.error(f"Failed Granule {i}: {e}")
+                        pbar.update(1)
+
+                        # Queue the batch once all of its granules have completed
+                        batch_remaining[b] -= 1
+                        if batch_remaining[b]:
+                            continue
+                        start_idx = b * self.batch_size
+                        end_idx = start_idx + len(batch_results[b])
+                        batch_path = self._get_checkpoint_path(station_code, product_type, start_idx)
+                        ds = self._build_checkpoint(var_name, batch_results.pop(b))
+                        if ds is None:
+                            # Every granule failed (e.g. a network outage); treat it like a failed write
+                            logger.warning(
+                                f"[{station_code}] - No valid granules in {start_idx}-{end_idx}. Checkpoint skipped.")
+                            failed_batches.append(batch_path)
+                        else:
+                            write_queue.put((batch_path, ds, f"{end_idx}/{total_granules}"))
+            except BaseException:
+                # Don't keep downloading granules whose results would be discarded (e.g. Ctrl-C)
+                ex.shutdown(wait=False, cancel_futures=True)
+                raise
+            finally:
+                # Sentinel stops the writer once all queued checkpoints are on disk
+                write_queue.put(None)
+                writer.join()
+
+        if failed_batches:
+            # Finalizing now would mark the station done without these batches
+            logger.error(
+                f"[{station_code}] {product_type}: {len(failed_batches)} batch(es) not saved. "
+                f"Not finalizing; rerun to redo the missing batches.")
+            return None
+
+        return self._finalize_station(station_code, product_type, final_path, checkpoint_starts)
 
-        return self._finalize_station(station_code, product_type, final_path)
+    def _build_checkpoint(self, var_name: str, batch: list) -> xr.Dataset|None:
+        """
+        Auxiliary: Stacks one batch of extracted pixels into a time-indexed Dataset.
+        Failed granules (None) are dropped; returns None if nothing is left.
+        """
+        batch = [px for px in batch if px is not None]
+        if not batch:
+            return None
+        # Granule timestamps are ISO strings, usually UTC with a 'Z' suffix. Fractional
+        # seconds are not always present, so the format is not inferred from the first one.
+        times = pd.to_datetime([px['time'] for px in batch], utc=True, format='ISO8601').tz_convert(None)
+        return xr.Dataset(
+            {var_name: (['time', 'wavelength'], np.stack([px[var_name] for px in batch]))},
+            coords={
+                'time': times.values.astype('datetime64[ns]'),
+                'wavelength': batch[0]['wavelength'],
+                'l2_flags': ('time', np.array([px['l2_flags'] for px in batch])),
+                'lat': ('time', np.array([px['lat'] for px in batch])),
+                'lon': ('time', np.array([px['lon'] for px in batch]))
+            },
+            # Lets finalization order checkpoints from the header alone
+            attrs={'time_coverage_start': times.min().isoformat()}
+        )
+
+    def _checkpoint_writer(self, write_queue: queue.Queue, written: dict[Path, str], failed: list[Path]):
+        """
+        Auxiliary: Writes queued (path, dataset, progress) checkpoints until a None sentinel arrives.
+        Successfully written paths are added to `written` with their start time, the others to `failed`.
+        """
+        while (item := write_queue.get()) is not None:
+            batch_path, ds, progress = item
+            try:
+                ds.to_netcdf(batch_path, engine='h5netcdf', encoding=_compression_encoding(ds))
+                written[batch_path] = ds.attrs['time_coverage_start']
+                logger.info(f"Saved Checkpoint: {batch_path.name} ({progress})")
+            except Exception as e:
+                logger.error(f"Failed Checkpoint {batch_path.name}: {e}")
+                failed.append(batch_path)
+                # Remove any partial file so the batch is redone on resume
+                batch_path.unlink(missing_ok=True)
 
-    def _finalize_station(self, station_code: str, product_type: str, final_path: Path) -> Path|None:
+    def _finalize_station(self, station_code: str, product_type: str, final_path: Path,
+                          checkpoint_starts: dict[Path, str|None]|None = None) -> Path|None:
         """
         Merges all checkpoint NetCDF files into a single sorted time-series and cleans up.
+
+        Args:
+            checkpoint_starts: Checkpoint paths mapped to their header start times, as read
+                by the caller. If None, the output directory is scanned and headers are read.
         """
-        checkpoints = sorted(list(
-            self.output_dir.glob(
-                f"checkpoint_{station_code}_{product_type}_b*.nc")
-        ))
+        if checkpoint_starts is None:
+            checkpoint_starts = self._read_checkpoint_starts(list(
+                self.output_dir.glob(
+                    f"checkpoint_{station_code}_{product_type}_b*.nc")
+            ))
                 
+        # Fallback for callers that skipped the extract-time check. A merge without the
+        # quarantined batches would be marked complete, so the station is left for a rerun.
+        if self._quarantine_checkpoints(station_code, checkpoint_starts):
+            logger.error(
+                f"[{station_code}] {product_type}: Corrupt checkpoints were set aside. "
+                f"Rerun extract_and_save to redo their batches.")
+            return None
+        checkpoints = sorted(checkpoint_starts, key=checkpoint_starts.get)
+
         if not checkpoints:
             logger.warning(f"[{station_code}] - No batches found to finalize.")
             return None
         
         logger.info(f"[{station_code}] - Merging {len(checkpoints)} checkpoints...")
         
-        # Open and concatenate all batches
-        with xr.open_mfdataset(checkpoints, combine='nested', concat_dim="time") as ds:
-            final_ds = ds.sortby('time').load() # Load into memory for final save
+        # Open and concatenate all batches. Checkpoints share the wavelength grid,
+        # so cross-file coordinate comparisons are skipped. The engine is given
+        # explicitly to avoid sniffing the format of every checkpoint.
+        with xr.open_mfdataset(
+            checkpoints, combine='nested', concat_dim="time",
+            compat='override', coords='minimal', data_vars='minimal', parallel=True,
+            engine='h5netcdf'
+        ) as ds:
+            # Checkpoints are already in start-time order; sort lazily only if batches overlap
+            final_ds = ds if ds.indexes['time'].is_monotonic_increasing else ds.sortby('time')
+            # Chunks given to open_mfdataset apply per file and never exceed batch_size,
+            # so uniform 256-step tiles are formed after the merge to bound the streamed write
+            final_ds = final_ds.chunk({'time': 256})
             final_ds.attrs['station_code'] = station_code
-            final_ds.to_netcdf(final_path)
+            # Write under a temporary name so a crash never leaves a partial final file.
+            # The data stays lazy, so dask streams it from checkpoints to the final file.
+            tmp_path = final_path.with_suffix('.nc.tmp')
+            final_ds.to_netcdf(tmp_path, engine='h5netcdf', encoding=_compression_encoding(final_ds))
+        os.replace(tmp_path, final_path)
+        # Completion marker lets later runs skip the station with a single stat
+        final_path.with_suffix('.done').touch()
         
         # Delete checkpoints only after successful final_save
         for cp in checkpoints:
@@ -156,9 +330,127 @@ class OverpassExtractor:
 
 
 
+# Caches below live in each worker process and persist across the granules it handles.
+# Nearest pixel (iy, ix) keyed by swath corners and station coordinates
+_pixel_cache = {}
+# Band wavelengths are fixed per product, keyed by variable name
+_wavelength_cache = {}
+
+
+def _find_nearest_pixel(lat_var, lon_var, lat: float, lon: float) -> tuple[int, int]:
+    """
+    Utility: Returns the (line, pixel) index closest to the station.
+    Granules sharing the same swath geometry reuse the cached index.
+    """
+    ny, nx = lat_var.shape
+    key = (
+        round(float(lat_var[0, 0]), 3), round(float(lat_var[ny - 1, nx - 1]), 3),
+        round(float(lon_var[0, 0]), 3), round(float(lon_var[ny - 1, nx - 1]), 3),
+        lat, lon
+    )
+    if key not in _pixel_cache:
+        # Squared distance preserves the argmin, so the sqrt is skipped
+        d2 = _read_variable(lat_var) - lat
+        d2 *= d2
+        tmp = _read_variable(lon_var) - lon
+        tmp *= tmp
+        d2 += tmp
+        _pixel_cache[key] = np.unravel_index(np.nanargmin(d2), d2.shape)
+    return _pixel_cache[key]
+
+
+def _extract_granule_pixel(file_obj, lat: float, lon: float, var_name: str) -> dict:
+    """
+    Utility: Opens a single PACE NetCDF and extracts the closest pixel spectra.
+    Handles the OCI hierarchical group structure through one h5py handle, reading
+    only the matched pixel from the geophysical data instead of the full swath.
+    Runs in the extractor's worker processes, so it is kept at module level.
+
+    Returns:
+        Dict of plain arrays for the pixel; batches are assembled in OverpassExtractor._build_checkpoint.
+    """
+    try:
+        # A single HDF5 handle; objects are addressed by path so only what is used is touched
+        with h5py.File(file_obj, 'r') as f:
+            nav = f['navigation_data']
+            geo = f['geophysical_data']
+            if var_name not in _wavelength_cache:
+                _wavelength_cache[var_name] = f['sensor_band_parameters/wavelength'][:]
+
+            iy, ix = _find_nearest_pixel(nav['latitude'], nav['longitude'], lat, lon)
+
+            return {
+                # float32 keeps well beyond the ~3 significant digits of the reflectances
+                var_name: _read_variable(geo[var_name], (iy, ix, slice(None))).astype(np.float32),
+                'wavelength': _wavelength_cache[var_name],
+                'time': _decode_attr(f.attrs['time_coverage_start']),
+                'l2_flags': _read_variable(geo['l2_flags'], (iy, ix)),
+                'lat': _read_variable(nav['latitude'], (iy, ix)),
+                'lon': _read_variable(nav['longitude'], (iy, ix))
+            }
+    finally:
+        # Releases the remote file's block cache as soon as the pixel is read
+        _close(file_obj)
+
+
+def _close(file_obj):
+    """Utility: Closes file-like granule handles; local paths are left as they are."""
+    if hasattr(file_obj, 'close'):
+        file_obj.close()
+
+
+def _read_variable(var, key=()):
+    """
+    Utility: Reads a (sliced) variable applying CF fill, scale and offset decoding,
+    as xarray would when opening the dataset.
+    """
+    data = var[key]
+    attrs = {a: _decode_attr(var.attrs[a])
+             for a in ('_FillValue', 'scale_factor', 'add_offset') if a in var.attrs}
+    if not attrs:
+        return data
+    data = np.asarray(data)
+    if data.dtype.kind in 'iu':
+        data = data.astype(np.float64)
+    if '_FillValue' in attrs:
+        data[data == attrs['_FillValue']] = np.nan
+    if 'scale_factor' in attrs:
+        data *= attrs['scale_factor']
+    if 'add_offset' in attrs:
+        data += attrs['add_offset']
+    return data
+
+
+def _decode_attr(value):
+    """Utility: Unwraps HDF5 attributes stored as bytes or single-element arrays."""
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray) and value.size == 1:
+        return value.item()
+    return value
+
+
+def _batch_number(path: Path) -> int:
+    """Utility: Parses the batch number from a checkpoint filename (..._b0003.nc -> 3)."""
+    return int(path.stem.rsplit('_b', 1)[1])
+
+
+def _checkpoint_start(path: Path) -> str:
+    """Utility: Reads the ISO start time stored in a checkpoint header ('' if missing)."""
+    with h5netcdf.File(path, 'r') as nc:
+        return str(nc.attrs.get('time_coverage_start', ''))
+
+
+def _compression_encoding(ds: xr.Dataset) -> dict:
+    """Utility: Builds a to_netcdf encoding that compresses every data variable."""
+    return {var: dict(COMPRESSION) for var in ds.data_vars}
+
+
 def filter_rrc(ds):
     """
-    Utility: Masks Land, Cloud, and Saturation based on standard PACE L2 flags.
+    Utility: Drops Land, Cloud, and Saturation observations based on standard PACE L2 flags.
+    Flags are per pixel, so the test runs over time only and flagged spectra are
+    removed rather than filled with NaN.
     """
-    mask = (ds.l2_flags & (1<<1 | 1<<3 | 1<<5)) == 0
-    return ds.where(mask)
\ No newline at end of file
+    good = (ds.l2_flags.values & MASK_BITS) == 0
+    return ds.isel(time=np.nonzero(good)[0])
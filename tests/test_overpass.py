@@ -2,7 +2,45 @@ import pytest
 import xarray as xr
 import numpy as np
 from pathlib import Path
-from overpass import OverpassExtractor
+import overpass
+from overpass import OverpassExtractor, filter_rrc
+
+
+def make_granule(path, time, ny=6, nx=5, n_wl=4):
+    """Writes a minimal file mimicking the PACE OCI L2 group layout."""
+    lat = np.linspace(30, 35, ny)[:, None] + np.zeros((1, nx))
+    lon = np.linspace(-120, -115, nx)[None, :] + np.zeros((ny, 1))
+    rrs = np.arange(ny * nx * n_wl).reshape(ny, nx, n_wl) * 1e-4
+    dims = ["number_of_lines", "pixels_per_line"]
+    xr.Dataset(attrs={"time_coverage_start": time}).to_netcdf(path)
+    xr.Dataset(
+        {"latitude": (dims, lat), "longitude": (dims, lon)},
+        attrs={"time_coverage_start": time},
+    ).to_netcdf(path, group="navigation_data", mode="a")
+    xr.Dataset(
+        {"Rrs": (dims + ["wavelength_3d"], rrs),
+         "l2_flags": (dims, np.zeros((ny, nx), dtype="int32"))}
+    ).to_netcdf(
+        path, group="geophysical_data", mode="a",
+        # PACE stores reflectances as scaled integers
+        encoding={"Rrs": {"dtype": "int16", "scale_factor": 2e-6, "add_offset": 0.05, "_FillValue": -32767}},
+    )
+    xr.Dataset(
+        {"wavelength": (["number_of_bands"], np.linspace(400, 700, n_wl))}
+    ).to_netcdf(path, group="sensor_band_parameters", mode="a")
+    return path
+
+
+@pytest.fixture
+def granules(tmp_path, monkeypatch):
+    src = tmp_path / "granules"
+    src.mkdir()
+    paths = [
+        make_granule(src / f"g{i}.nc", f"2024-05-{i + 1:02d}T20:00:00Z") for i in range(5)
+    ]
+    # earthaccess.open returns file-like objects; local paths stand in for them
+    monkeypatch.setattr(overpass.earthaccess, "open", lambda g: list(g))
+    return paths
 
 def test_directory_creation(tmp_path):
     # tmp_path is a built-in pytest fixture that is a pathlib.Path object
@@ -14,9 +52,146 @@ def test_resume_logic(tmp_path):
     test_file = tmp_path / "TEST_Rrs_final.nc"
     
     # Create a dummy final file
-    ds = xr.Dataset({"Rrs": (["w"], [1, 2])}, coords={"w": [400, 500]})
+    ds = xr.Dataset({"Rrs": (["w"], [1, 2])}, coords={"w": [400, 500]}, attrs={"station_code": "TEST"})
     ds.to_netcdf(test_file)
     
     # This should return immediately without trying to "download"
     result = ex.extract_and_save("TEST", [], 0, 0, "Rrs")
-    assert result is not None
\ No newline at end of file
+    assert result is not None
+
+
+def test_incomplete_final_not_skipped(tmp_path):
+    ex = OverpassExtractor(output_dir=tmp_path, batch_size=2)
+    final = tmp_path / "TEST_Rrs_final.nc"
+
+    # An unreadable final file is treated as a partial write
+    final.write_bytes(b"truncated")
+    assert not ex._is_finalized(final, "TEST")
+
+    # So is a valid file without the station_code sentinel, or with another station's
+    ds = xr.Dataset({"Rrs": (["w"], [1, 2])}, coords={"w": [400, 500]})
+    ds.to_netcdf(final)
+    assert not ex._is_finalized(final, "TEST")
+    ds.assign_attrs(station_code="OTHER").to_netcdf(final)
+    assert not ex._is_finalized(final, "TEST")
+
+
+def test_find_granules(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(overpass.earthaccess, "search_data", lambda **kwargs: calls.append(kwargs) or ["g"])
+    ex = OverpassExtractor(output_dir=tmp_path)
+
+    assert ex.find_granules("Rrc", 32.0, -117.5, ("2024-04-11", "2024-05-01")) == ["g"]
+    assert calls[0]["short_name"] == "PACE_OCI_L2_RRC"
+    assert calls[0]["temporal"] == ("2024-04-11", "2024-05-01")
+
+
+def test_extract_and_save(tmp_path, granules):
+    ex = OverpassExtractor(output_dir=tmp_path / "out", batch_size=2, max_workers=4)
+    result = ex.extract_and_save("TEST", granules, 32.0, -117.5, "Rrs")
+
+    ds = xr.open_dataset(result)
+    assert ds.sizes["time"] == len(granules)
+    assert (np.diff(ds.time.values) > np.timedelta64(0)).all()
+    assert not list((tmp_path / "out").glob("checkpoint_*"))
+    assert result.with_suffix(".done").exists()
+
+
+def test_extract_granule_pixel(granules, monkeypatch):
+    monkeypatch.setattr(overpass, "_pixel_cache", {})
+    px = overpass._extract_granule_pixel(granules[0], 32.0, -117.5, "Rrs")
+
+    # Station is nearest to line 2, pixel 2 of the 6x5 test swath
+    expected = np.arange(6 * 5 * 4).reshape(6, 5, 4)[2, 2] * 1e-4
+    np.testing.assert_allclose(px["Rrs"], expected, atol=2e-6)
+    assert float(px["lat"]) == 32.0 and float(px["lon"]) == -117.5
+
+    # Test granules share one swath, so the second lookup hits the cache
+    overpass._extract_granule_pixel(granules[1], 32.0, -117.5, "Rrs")
+    assert len(overpass._pixel_cache) == 1
+
+
+def test_filter_rrc():
+    ds = xr.Dataset(
+        {"Rrc": (["time", "wavelength"], np.ones((4, 3)))},
+        coords={"l2_flags": ("time", [0, 1 << 1, 1 << 4, 1 << 3 | 1 << 5])},
+    )
+    # Only bits 1, 3 and 5 reject an observation
+    assert list(filter_rrc(ds).l2_flags.values) == [0, 1 << 4]
+
+
+def test_corrupt_checkpoint_quarantined(tmp_path, granules):
+    ex = OverpassExtractor(output_dir=tmp_path / "out", batch_size=2)
+    bad = ex._get_checkpoint_path("TEST", "Rrs", 0)
+    bad.write_bytes(b"truncated")
+
+    # The corrupt first batch is set aside and redone, so no granules are lost
+    result = ex.extract_and_save("TEST", granules, 32.0, -117.5, "Rrs")
+    assert xr.open_dataset(result).sizes["time"] == len(granules)
+    assert bad.with_suffix(".bad").exists()
+
+
+def test_corrupt_checkpoint_blocks_finalize(tmp_path, granules):
+    ex = OverpassExtractor(output_dir=tmp_path / "out", batch_size=2)
+    bad = ex._get_checkpoint_path("TEST", "Rrs", 0)
+    bad.write_bytes(b"truncated")
+
+    # Finalizing directly still sets the file aside but leaves the station unfinished
+    final = tmp_path / "out" / "TEST_Rrs_final.nc"
+    assert ex._finalize_station("TEST", "Rrs", final) is None
+    assert bad.with_suffix(".bad").exists()
+    assert not final.exists() and not final.with_suffix(".done").exists()
+
+
+def test_legacy_checkpoints_not_resumed(tmp_path, granules):
+    ex = OverpassExtractor(output_dir=tmp_path / "out", batch_size=2)
+    # Checkpoints from before start-index numbering carry no time_coverage_start header
+    legacy = ex._get_checkpoint_path("TEST", "Rrs", 2)
+    xr.Dataset({"Rrs": (["time", "wavelength"], np.ones((2, 4)))}).to_netcdf(legacy)
+
+    assert ex.extract_and_save("TEST", granules, 32.0, -117.5, "Rrs") is None
+    assert legacy.exists()
+
+
+def test_failed_checkpoint_write_redone(tmp_path, granules, monkeypatch):
+    ex = OverpassExtractor(output_dir=tmp_path / "out", batch_size=2)
+    real_to_netcdf = xr.Dataset.to_netcdf
+
+    def flaky_to_netcdf(ds, path, *args, **kwargs):
+        if Path(path).name.endswith("_b0001.nc"):
+            Path(path).write_bytes(b"partial")
+            raise OSError("disk full")
+        return real_to_netcdf(ds, path, *args, **kwargs)
+
+    # A failed write skips finalization and leaves no partial checkpoint behind
+    monkeypatch.setattr(xr.Dataset, "to_netcdf", flaky_to_netcdf)
+    assert ex.extract_and_save("TEST", granules, 32.0, -117.5, "Rrs") is None
+    assert not ex._get_checkpoint_path("TEST", "Rrs", 2).exists()
+
+    # The next run redoes only the missing batch and finalizes everything
+    monkeypatch.setattr(xr.Dataset, "to_netcdf", real_to_netcdf)
+    result = ex.extract_and_save("TEST", granules, 32.0, -117.5, "Rrs")
+    assert xr.open_dataset(result).sizes["time"] == len(granules)
+
+
+def test_failed_batch_not_finalized(tmp_path, granules):
+    ex = OverpassExtractor(output_dir=tmp_path / "out", batch_size=2)
+    # Every granule of the second batch fails to open
+    broken = granules[:2] + [tmp_path / "missing2.nc", tmp_path / "missing3.nc"] + granules[4:]
+
+    final = tmp_path / "out" / "TEST_Rrs_final.nc"
+    assert ex.extract_and_save("TEST", broken, 32.0, -117.5, "Rrs") is None
+    assert not final.exists()
+
+    # The next run redoes only the empty batch and finalizes everything
+    result = ex.extract_and_save("TEST", granules, 32.0, -117.5, "Rrs")
+    assert xr.open_dataset(result).sizes["time"] == len(granules)
+
+
+def test_build_checkpoint_mixed_timestamps(tmp_path):
+    ex = OverpassExtractor(output_dir=tmp_path)
+    px = {"Rrs": np.ones(4, "float32"), "wavelength": np.arange(4.0), "l2_flags": 0, "lat": 0.0, "lon": 0.0}
+    batch = [dict(px, time="2024-05-01T20:00:00Z"), dict(px, time="2024-05-02T20:00:00.123Z")]
+
+    ds = ex._build_checkpoint("Rrs", batch)
+    assert ds.time.values[1] == np.datetime64("2024-05-02T20:00:00.123")